@@ -1,15 +1,21 @@
 import streamlit as st
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part
-import json
+import streamlit.components.v1 as components
+import orjson
 import re
-from google.oauth2 import service_account
 from datetime import date
-import math
-from PIL import Image
+import asyncio
 import io
-import html
 import base64
+import hashlib
+import hmac
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import jinja2
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 
 # ----------------------------------------------------------------------
 # 1. 設定と定数
@@ -20,7 +26,26 @@ st.set_page_config(
     layout="wide",
     initial_sidebar_state="collapsed"  # サイドバーを最初から非表示
 )
-BATCH_SIZE = 10 # 一度にAIに送信する写真の枚数
+BATCH_SIZE = 10 # 一度にAIに送信する写真の枚数の上限
+AI_IMAGE_MAX_EDGE = 1568 # AIに送る写真の長辺の上限（px）
+MAX_BATCH_BYTES = 15 * 1024 * 1024 # 一度にAIに送信する写真の合計サイズの上限（リクエスト上限20MBに余裕を持たせる）
+MAX_CONCURRENT_REQUESTS = 4 # AIへ同時に送信するバッチ数の上限
+AI_MAX_ATTEMPTS = 5 # クォータ超過などの一時的なエラー時に、1バッチを送信する最大回数
+AI_CACHE_TTL = 60*60 # AIの分析結果を再利用する期間（秒）
+AI_CACHE_MAX_ENTRIES = 1024 # AIの分析結果を保持する写真枚数の上限
+AI_CACHE_DIR = Path(__file__).parent / ".cache" / "analysis"  # 分析結果をプロセス再起動後も残しておく場所
+AI_DISK_CACHE_TTL = 7*24*60*60 # ディスク上の分析結果を再利用する期間（秒）
+AI_DISK_CACHE_MAX_FILES = 5000 # ディスクに残す分析結果の写真枚数の上限
+STATIC_DIR = Path(__file__).parent / "static"  # enableStaticServingで配信されるディレクトリ
+STATIC_URL = "app/static"
+DISPLAY_IMAGE_TTL = 24*60*60 # 表示用画像を再利用・配信しておく期間（秒）
+STATIC_PRUNE_INTERVAL = 60*60 # 期限切れの表示用画像を削除する間隔（秒）
+CSS_PATH = Path(__file__).parent / "style.css"  # 画面・印刷共通のスタイル
+PRINT_CSS_PATH = Path(__file__).parent / "print.css"  # 印刷時だけ適用するスタイル
+EDIT_EXPANDED_PHOTOS = 5 # 編集画面で最初から写真を展開しておく枚数
+PROGRESS_INTERVAL = 0.5 # 進捗表示を更新する最短間隔（秒）
+PRIORITY_OPTIONS = ['高', '中', '低']  # 緊急度の選択肢
+GEMINI_MODEL_NAME = "gemini-1.5-pro"  # 分析に使うモデル
 
 # セッション状態の初期化
 if 'processing' not in st.session_state:
@@ -33,13 +58,29 @@ if 'edit_mode' not in st.session_state:
     st.session_state.edit_mode = False
 if 'edited_report' not in st.session_state:
     st.session_state.edited_report = None
+if 'edit_baseline_hash' not in st.session_state:
+    st.session_state.edit_baseline_hash = None
+if 'report_summary' not in st.session_state:
+    st.session_state.report_summary = None
+if 'unanalyzed_files' not in st.session_state:
+    st.session_state.unanalyzed_files = []
+if 'analysis_error' not in st.session_state:
+    st.session_state.analysis_error = None
+if 'finding_editor_base' not in st.session_state:
+    st.session_state.finding_editor_base = {}
+if 'thumbnail_cache' not in st.session_state:
+    st.session_state.thumbnail_cache = {}
+if 'row_html_cache' not in st.session_state:
+    st.session_state.row_html_cache = {}
+if 'prewarm_key' not in st.session_state:
+    st.session_state.prewarm_key = None
 
 # ----------------------------------------------------------------------
 # パスワード認証機能
 # ----------------------------------------------------------------------
-# secrets.tomlから安全にパスワード取得
+# secrets.tomlから安全にパスワード取得（平文は保持せず、ハッシュ値だけを残す）
 try:
-    PASSWORD = st.secrets["PASSWORD"]
+    PASSWORD_HASH = hashlib.sha256(st.secrets["PASSWORD"].encode("utf-8")).digest()
 except KeyError:
     st.error("パスワードが設定されていません。管理者に連絡してください。")
     st.info("secrets.tomlファイルに'PASSWORD'を設定する必要があります。")
@@ -47,7 +88,9 @@ except KeyError:
 
 def check_password():
     def password_entered():
-        if st.session_state["password"] == PASSWORD:
+        # 一致するまでの時間から推測されないよう、定数時間で比較する
+        entered_hash = hashlib.sha256(st.session_state["password"].encode("utf-8")).digest()
+        if hmac.compare_digest(entered_hash, PASSWORD_HASH):
             st.session_state["password_correct"] = True
             del st.session_state["password"]
         else:
@@ -66,647 +109,99 @@ def check_password():
 # ----------------------------------------------------------------------
 # 2. デザインとGCP初期化
 # ----------------------------------------------------------------------
+_CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+_CSS_SPACE_RE = re.compile(r'\s+')
+_CSS_PUNCT_SPACE_RE = re.compile(r'\s*([{};,>])\s*')
+
+@st.cache_data(show_spinner=False)
+def load_custom_css(path):
+    """CSSファイルを読み込み、コメントと余分な空白を除いて返す（ファイルごとに一度だけ実行される）"""
+    css = path.read_text(encoding="utf-8")
+    css = _CSS_COMMENT_RE.sub('', css)
+    css = _CSS_SPACE_RE.sub(' ', css)
+    return _CSS_PUNCT_SPACE_RE.sub(r'\1', css).strip()
+
 def inject_custom_css():
     """印刷用のカスタムCSSを注入する。"""
-    st.markdown("""
-    <style>
-        /* ========== グローバルテーマ設定 ========== */
-        /* Streamlitのダークモードを完全に無効化 */
-        :root {
-            color-scheme: light !important;
-        }
-        
-        /* アプリ全体の背景を白に */
-        html, body, .stApp, [data-testid="stAppViewContainer"], .main {
-            background-color: #ffffff !important;
-            color: #1f2937 !important;
-        }
-        
-        /* ========== テキスト要素のスタイル ========== */
-        /* すべての見出し */
-        h1, h2, h3, h4, h5, h6,
-        .stApp h1, .stApp h2, .stApp h3, .stApp h4, .stApp h5, .stApp h6 {
-            color: #1f2937 !important;
-            font-weight: 300 !important;
-            letter-spacing: -0.02em !important;
-        }
-        
-        /* 段落とスパン */
-        p, span, label, .stMarkdown, .stText {
-            color: #374151 !important;
-        }
-        
-        /* ========== 入力要素のスタイル ========== */
-        /* テキスト入力のラベル */
-        [data-testid="stTextInput"] label,
-        [data-testid="stDateInput"] label,
-        [data-testid="stFileUploader"] label,
-        .stTextInput label,
-        .stDateInput label,
-        .stFileUploader label {
-            color: #1f2937 !important;
-            font-weight: 500 !important;
-            opacity: 1 !important;
-            font-size: 0.875rem !important;
-            letter-spacing: 0.05em !important;
-        }
-        
-        /* テキスト入力フィールド */
-        [data-testid="stTextInput"] input,
-        .stTextInput input {
-            background-color: #ffffff !important;
-            color: #1f2937 !important;
-            border: 1px solid #e5e7eb !important;
-            border-radius: 0 !important;
-            transition: border-color 0.2s !important;
-        }
-        
-        [data-testid="stTextInput"] input:focus,
-        .stTextInput input:focus {
-            border-color: #3b82f6 !important;
-            box-shadow: 0 0 0 1px #3b82f6 !important;
-        }
-        
-        /* 日付入力フィールド */
-        [data-testid="stDateInput"] input,
-        .stDateInput input {
-            background-color: #ffffff !important;
-            color: #1f2937 !important;
-            border: 1px solid #e5e7eb !important;
-            border-radius: 0 !important;
-        }
-        
-        /* ファイルアップローダー */
-        [data-testid="stFileUploadDropzone"],
-        .stFileUploader > div {
-            background-color: #fafafa !important;
-            border: 1px solid #e5e7eb !important;
-            border-radius: 0 !important;
-            transition: all 0.2s !important;
-        }
-        
-        [data-testid="stFileUploadDropzone"]:hover {
-            border-color: #3b82f6 !important;
-            background-color: #f9fafb !important;
-        }
-        
-        [data-testid="stFileUploadDropzone"] svg {
-            color: #9ca3af !important;
-        }
-        
-        [data-testid="stFileUploadDropzone"] p,
-        [data-testid="stFileUploadDropzone"] span {
-            color: #6b7280 !important;
-            font-size: 0.875rem !important;
-        }
-        
-        /* テキストエリア */
-        [data-testid="stTextArea"] textarea,
-        .stTextArea textarea {
-            background-color: #ffffff !important;
-            color: #1f2937 !important;
-            border: 1px solid #e5e7eb !important;
-            border-radius: 0 !important;
-            font-size: 0.875rem !important;
-        }
-        
-        [data-testid="stTextArea"] textarea:focus,
-        .stTextArea textarea:focus {
-            border-color: #3b82f6 !important;
-            box-shadow: 0 0 0 1px #3b82f6 !important;
-        }
-        
-        /* セレクトボックス */
-        [data-testid="stSelectbox"] > div > div,
-        .stSelectbox > div > div {
-            background-color: #ffffff !important;
-            color: #1f2937 !important;
-            border: 1px solid #e5e7eb !important;
-            border-radius: 0 !important;
-        }
-        
-        /* ========== ボタンのスタイル ========== */
-        .stButton > button {
-            background-color: #ffffff !important;
-            color: #1f2937 !important;
-            border: 2px solid #1f2937 !important;
-            font-weight: 600 !important;
-            border-radius: 0 !important;
-            padding: 0.75rem 2rem !important;
-            letter-spacing: 0.05em !important;
-            font-size: 0.875rem !important;
-            transition: all 0.2s !important;
-        }
-        
-        .stButton > button:hover:not(:disabled) {
-            background-color: #1f2937 !important;
-            color: #ffffff !important;
-            transform: translateY(-1px) !important;
-            box-shadow: 0 4px 6px -1px rgba(0, 0, 0, 0.1) !important;
-        }
-        
-        .stButton > button:disabled {
-            background-color: #f3f4f6 !important;
-            color: #9ca3af !important;
-            border-color: #e5e7eb !important;
-            opacity: 0.6 !important;
-        }
-        
-        /* ========== アラートメッセージ ========== */
-        /* 成功メッセージ */
-        .stSuccess, [data-testid="stAlert"][data-baseweb="notification"][kind="success"] {
-            background-color: #f0fdf4 !important;
-            color: #14532d !important;
-            border-left: 3px solid #22c55e !important;
-            border-radius: 0 !important;
-        }
-        
-        .stSuccess svg {
-            color: #22c55e !important;
-        }
-        
-        /* 警告メッセージ */
-        .stWarning, [data-testid="stAlert"][data-baseweb="notification"][kind="warning"] {
-            background-color: #fffbeb !important;
-            color: #581c0c !important;
-            border-left: 3px solid #f59e0b !important;
-            border-radius: 0 !important;
-        }
-        
-        .stWarning svg {
-            color: #f59e0b !important;
-        }
-        
-        /* 情報メッセージ */
-        .stInfo, [data-testid="stAlert"][data-baseweb="notification"][kind="info"] {
-            background-color: #eff6ff !important;
-            color: #1e3a8a !important;
-            border-left: 3px solid #3b82f6 !important;
-            border-radius: 0 !important;
-        }
-        
-        .stInfo svg {
-            color: #3b82f6 !important;
-        }
-        
-        /* ========== プログレスバー ========== */
-        .stProgress > div > div {
-            background-color: #f3f4f6 !important;
-            border-radius: 0 !important;
-        }
-        
-        .stProgress > div > div > div {
-            background-color: #1f2937 !important;
-            border-radius: 0 !important;
-        }
-        
-        /* エクスパンダー */
-        [data-testid="stExpander"] {
-            border: 1px solid #e5e7eb !important;
-            border-radius: 0 !important;
-            background-color: #ffffff !important;
-        }
-        
-        [data-testid="stExpander"] summary {
-            background-color: #f9fafb !important;
-            font-weight: 500 !important;
-            color: #1f2937 !important;
-        }
-        
-        [data-testid="stExpander"] summary:hover {
-            background-color: #f3f4f6 !important;
-        }
-        
-        /* セクション区切り線 */
-        hr {
-            border: none !important;
-            border-top: 1px solid #e5e7eb !important;
-            margin: 2rem 0 !important;
-        }
-        
-        /* ========== カスタムスタイル ========== */
-        /* 基本スタイル */
-        .report-header {
-            text-align: center;
-            padding: 3rem 0 2rem;
-            border-bottom: 1px solid #e5e7eb;
-            margin-bottom: 3rem;
-            background: #ffffff;
-        }
-        
-        .report-header h1 {
-            font-size: 2.5rem !important;
-            font-weight: 200 !important;
-            letter-spacing: -0.03em !important;
-            margin-bottom: 0.5rem !important;
-        }
-        
-        /* 印刷ガイダンス */
-        .print-guidance {
-            background: #f9fafb;
-            border: 1px solid #e5e7eb;
-            border-radius: 0;
-            padding: 1.5rem;
-            margin-bottom: 3rem;
-            text-align: left;
-            line-height: 1.8;
-        }
-        
-        .print-guidance strong {
-            color: #1f2937;
-            font-size: 1rem;
-            font-weight: 600;
-            display: block;
-            margin-bottom: 0.5rem;
-        }
-        
-        /* サマリーカード */
-        .metric-card {
-            background: #ffffff;
-            border: 1px solid #e5e7eb;
-            padding: 2rem;
-            border-radius: 0;
-            text-align: center;
-            height: 100%;
-            transition: all 0.2s;
-        }
-        
-        .metric-card:hover {
-            border-color: #d1d5db;
-            box-shadow: 0 4px 6px -1px rgba(0, 0, 0, 0.05);
-        }
-        
-        .metric-value {
-            font-size: 3.5rem;
-            font-weight: 200;
-            margin-bottom: 0.5rem;
-            color: #1f2937;
-            letter-spacing: -0.03em;
-        }
-        
-        .metric-value-high {
-            color: #dc2626;
-        }
-        
-        .metric-label {
-            font-size: 0.875rem;
-            color: #6b7280;
-            font-weight: 500;
-            letter-spacing: 0.05em;
-        }
-        
-        /* 写真セクション（横並びレイアウト） */
-        .photo-row {
-            display: flex;
-            gap: 2rem;
-            margin-bottom: 2rem;
-            background: #ffffff;
-            border: 1px solid #e5e7eb;
-            border-radius: 0;
-            padding: 2rem;
-            page-break-inside: avoid;
-            break-inside: avoid;
-        }
-        
-        .photo-container {
-            flex: 0 0 300px;
-            max-width: 300px;
-        }
-        
-        .photo-img {
-            width: 100%;
-            height: auto;
-            max-height: 225px;
-            object-fit: contain;
-            border-radius: 0;
-            border: 1px solid #e5e7eb;
-            background: #fafafa;
-        }
-        
-        .content-container {
-            flex: 1;
-            min-width: 0;
-            padding-left: 1.5rem;
-        }
-        
-        .photo-title {
-            font-size: 1rem;
-            font-weight: 500;
-            color: #1f2937;
-            margin-bottom: 1rem;
-            letter-spacing: 0.05em;
-        }
-        
-        .photo-filename {
-            font-size: 0.75rem;
-            color: #9ca3af;
-            font-weight: 400;
-            text-transform: none;
-            letter-spacing: normal;
-        }
-        
-        /* 指摘事項のスタイル */
-        .finding-high {
-            background: #fef2f2;
-            border-left: 3px solid #dc2626;
-            padding: 0.75rem 1rem;
-            margin-bottom: 0.75rem;
-            border-radius: 0;
-            color: #7f1d1d;
-            font-size: 0.875rem;
-        }
-        
-        .finding-medium {
-            background: #fffbeb;
-            border-left: 3px solid #f59e0b;
-            padding: 0.75rem 1rem;
-            margin-bottom: 0.75rem;
-            border-radius: 0;
-            color: #78350f;
-            font-size: 0.875rem;
-        }
-        
-        .finding-low {
-            background: #eff6ff;
-            border-left: 3px solid #3b82f6;
-            padding: 0.75rem 1rem;
-            margin-bottom: 0.75rem;
-            border-radius: 0;
-            color: #1e3a8a;
-            font-size: 0.875rem;
-        }
-        
-        .finding-location {
-            font-weight: 600;
-            margin-bottom: 0.5rem;
-            font-size: 0.875rem;
-            letter-spacing: 0.05em;
-        }
-        
-        .finding-details {
-            line-height: 1.6;
-            font-size: 0.875rem;
-        }
-        
-        .finding-details > div {
-            margin-bottom: 0.25rem;
-        }
-        
-        .observation-box {
-            background: #f0fdf4;
-            padding: 1rem;
-            border-radius: 0;
-            color: #14532d;
-            font-size: 0.875rem;
-            border-left: 3px solid #22c55e;
-        }
-        
-        .no-finding-box {
-            background: #f0fdf4;
-            color: #14532d;
-            padding: 1rem;
-            text-align: center;
-            border-radius: 0;
-            font-size: 0.875rem;
-            border: 1px solid #bbf7d0;
-        }
-        
-        /* 編集エリアのスタイル */
-        .edit-container {
-            background: #fafafa;
-            padding: 1.5rem;
-            border-radius: 0;
-            margin-bottom: 1rem;
-            border: 1px solid #e5e7eb;
-        }
-        
-        /* Section headers */
-        h2 {
-            font-size: 1.5rem !important;
-            font-weight: 300 !important;
-            margin-bottom: 1.5rem !important;
-            margin-top: 2rem !important;
-            padding-bottom: 0.5rem !important;
-            border-bottom: 1px solid #e5e7eb !important;
-        }
-        
-        /* ========== 印刷用スタイル ========== */
-        @media print {
-            /* 背景を白に設定 */
-            body, .stApp {
-                background: white !important;
-                background-color: white !important;
-                margin: 0 !important;
-                padding: 0 !important;
-            }
-            
-            /* ページの余白を設定 */
-            @page {
-                size: A4;
-                margin: 20mm 15mm 20mm 15mm;
-            }
-            
-            /* ブラウザのヘッダー/フッターを非表示 */
-            @page {
-                @top-left-corner { content: none !important; }
-                @top-left { content: none !important; }
-                @top-center { content: none !important; }
-                @top-right { content: none !important; }
-                @top-right-corner { content: none !important; }
-                @bottom-left-corner { content: none !important; }
-                @bottom-left { content: none !important; }
-                @bottom-center { content: none !important; }
-                @bottom-right { content: none !important; }
-                @bottom-right-corner { content: none !important; }
-            }
-            
-            /* リンクのURLを非表示 */
-            a[href]:after {
-                content: none !important;
-            }
-            
-            /* Streamlitの要素を非表示 */
-            header[data-testid="stHeader"],
-            [data-testid="stToolbar"],
-            .stAlert,
-            .stProgress,
-            .stInfo,
-            .stSuccess,
-            .print-guidance,
-            button,
-            [data-testid="column"]:has(button),
-            .stCaption,
-            .st-emotion-cache-1wrcr25,
-            .st-emotion-cache-12w0qpk,
-            footer,
-            .edit-container,
-            .stTextInput,
-            .stTextArea,
-            .stSelectbox {
-                display: none !important;
-            }
-            
-            /* メインコンテンツの背景を白に */
-            .main, .block-container, section.main > div {
-                background: white !important;
-                background-color: white !important;
-            }
-            
-            /* タイトルとヘッダー */
-            .report-header {
-                border-bottom: 1px solid #333 !important;
-                background: white !important;
-                page-break-after: avoid !important;
-            }
-            
-            h1, h2, h3 {
-                color: #000 !important;
-                page-break-after: avoid !important;
-            }
-            
-            /* サマリーカード */
-            .metric-card {
-                background: white !important;
-                border: 1px solid #333 !important;
-                page-break-inside: avoid !important;
-            }
-            
-            .metric-value {
-                color: #000 !important;
-            }
-            
-            .metric-value-high {
-                color: #dc2626 !important;
-            }
-            
-            /* 写真行の印刷設定 */
-            .photo-row {
-                page-break-inside: avoid !important;
-                margin-bottom: 15px !important;
-                padding: 15px !important;
-                background: white !important;
-                border: 1px solid #333 !important;
-            }
-            
-            /* 写真のサイズ調整 */
-            .photo-container {
-                flex: 0 0 200px !important;
-                max-width: 200px !important;
-            }
-            
-            .photo-img {
-                max-height: 150px !important;
-                border: 1px solid #333 !important;
-            }
-            
-            /* テキストスタイル */
-            .photo-title {
-                font-size: 0.9rem !important;
-                color: #000 !important;
-            }
-            
-            .photo-filename {
-                font-size: 0.75rem !important;
-                color: #6b7280 !important;
-                font-weight: normal !important;
-            }
-            
-            .finding-high {
-                background: #fee2e2 !important;
-                border-left: 3px solid #dc2626 !important;
-                color: #7f1d1d !important;
-                -webkit-print-color-adjust: exact !important;
-                print-color-adjust: exact !important;
-            }
-            
-            .finding-medium {
-                background: #fef3c7 !important;
-                border-left: 3px solid #f59e0b !important;
-                color: #78350f !important;
-                -webkit-print-color-adjust: exact !important;
-                print-color-adjust: exact !important;
-            }
-            
-            .finding-low {
-                background: #dbeafe !important;
-                border-left: 3px solid #3b82f6 !important;
-                color: #1e3a8a !important;
-                -webkit-print-color-adjust: exact !important;
-                print-color-adjust: exact !important;
-            }
-            
-            .observation-box {
-                background: #d1fae5 !important;
-                color: #064e3b !important;
-                -webkit-print-color-adjust: exact !important;
-                print-color-adjust: exact !important;
-            }
-            
-            .no-finding-box {
-                background: #d1fae5 !important;
-                color: #047857 !important;
-                -webkit-print-color-adjust: exact !important;
-                print-color-adjust: exact !important;
-            }
-            
-            .finding-details {
-                font-size: 0.7rem !important;
-            }
-            
-            /* 全ての要素の背景を白に */
-            * {
-                background-color: transparent !important;
-            }
-            
-            /* ベースの背景を白に */
-            html, body {
-                background: white !important;
-                background-color: white !important;
-            }
-        }
-        
-        /* Ctrl+Pを無効化 */
-        @media screen {
-            body {
-                -webkit-user-select: text;
-                -moz-user-select: text;
-                -ms-user-select: text;
-                user-select: text;
-            }
-        }
-    </style>
-    
+    # 印刷用のルールは別のstyle要素にし、画面表示では適用対象から外す
+    st.markdown(
+        f'<style>{load_custom_css(CSS_PATH)}</style>'
+        f'<style media="print">{load_custom_css(PRINT_CSS_PATH)}</style>',
+        unsafe_allow_html=True
+    )
+
+def inject_print_shortcut_hook():
+    """Ctrl+P / Cmd+Pを無効化するスクリプトを親ドキュメントに一度だけ登録する。"""
+    # st.markdownではscriptが実行されないため、コンポーネントのiframeから親に登録する。
+    # 同一内容のコンポーネントは再実行時に再マウントされず、JS側のフラグで重複登録も防ぐ。
+    components.html("""
     <script>
-        // Ctrl+P / Cmd+Pを無効化
-        document.addEventListener('keydown', function(e) {
-            if ((e.ctrlKey || e.metaKey) && e.key === 'p') {
-                e.preventDefault();
-                alert('PDFとして保存するには、画面右上の「⋮」メニューから「Print」を選択してください。\\n\\n印刷設定で「ヘッダーとフッター」のチェックを外すと、URLや日付が表示されません。');
-                return false;
-            }
-        });
+        const doc = window.parent.document;
+        if (!doc.__printShortcutHooked) {
+            doc.__printShortcutHooked = true;
+            // Ctrl+P / Cmd+Pを無効化
+            doc.addEventListener('keydown', function(e) {
+                if ((e.ctrlKey || e.metaKey) && e.key === 'p') {
+                    e.preventDefault();
+                    window.parent.alert('PDFとして保存するには、画面右上の「⋮」メニューから「Print」を選択してください。\\n\\n印刷設定で「ヘッダーとフッター」のチェックを外すと、URLや日付が表示されません。');
+                    return false;
+                }
+            });
+        }
     </script>
-    """, unsafe_allow_html=True)
+    """, height=0)
+
+@st.cache_resource
+def get_gcp_credentials():
+    """サービスアカウントの認証情報を生成する（全セッションで1つだけ保持）"""
+    # 重いライブラリは認証画面の表示を遅らせないよう、初回使用時に読み込む
+    from google.oauth2 import service_account
+    service_account_info = orjson.loads(st.secrets["gcp"]["gcp_service_account"])
+    return service_account.Credentials.from_service_account_info(service_account_info)
 
 @st.cache_resource
 def initialize_vertexai():
+    """Vertex AIを初期化し、成功したかどうかを返す（全セッションで1回だけ実行）"""
+    import vertexai
     try:
         if "gcp" not in st.secrets:
             st.error("GCP認証情報が設定されていません。")
             st.info("secrets.tomlファイルにGCPの認証情報を設定してください。")
             return None
         gcp_secrets = st.secrets["gcp"]
-        service_account_info = json.loads(gcp_secrets["gcp_service_account"])
-        credentials = service_account.Credentials.from_service_account_info(service_account_info)
+        credentials = get_gcp_credentials()
         vertexai.init(project=gcp_secrets["project_id"], location="asia-northeast1", credentials=credentials)
-        return GenerativeModel("gemini-1.5-pro")
+        return True
     except Exception as e:
         st.error(f"GCP認証の初期化に失敗しました: {e}")
         return None
 
+def create_report_model():
+    """分析用のモデルを作成する（非同期クライアントは作成時のイベントループに紐づくため、asyncio.runのたびに作り直す）"""
+    from vertexai.generative_models import GenerativeModel
+    return GenerativeModel(GEMINI_MODEL_NAME)
+
 # ----------------------------------------------------------------------
 # 3. AIとデータ処理の関数
 # ----------------------------------------------------------------------
+def plan_batches(file_names, files_dict):
+    """写真をほぼ均等なバッチに分ける（枚数が少ないときは同時送信数いっぱいまで分散し、合計サイズも制限する）"""
+    batch_count = max(-(-len(file_names) // BATCH_SIZE), min(len(file_names), MAX_CONCURRENT_REQUESTS))
+    batch_size = max(1, -(-len(file_names) // max(1, batch_count)))
+    batches = []
+    batch, batch_bytes = [], 0
+    for name in file_names:
+        size = len(files_dict[name]['bytes'])
+        # 枚数かサイズのどちらかが上限に達したら次のバッチへ
+        if batch and (len(batch) >= batch_size or batch_bytes + size > MAX_BATCH_BYTES):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(name)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
 def create_report_prompt(filenames):
     file_list_str = "\n".join([f"- {name}" for name in filenames])
     return f"""
@@ -730,110 +225,467 @@ def create_report_prompt(filenames):
     それでは、以下の写真の分析を開始してください。
     """
 
-def generate_ai_report(model, file_batch, prompt):
-    image_parts = [Part.from_data(f.getvalue(), mime_type=f.type) for f in file_batch]
-    response = model.generate_content([prompt] + image_parts)
-    return response.text
+# 応答をJSONに制約するための出力スキーマ（プロンプトで指示している構造と同じ）
+REPORT_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "file_name": {"type": "string"},
+            "findings": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "location": {"type": "string"},
+                        "current_state": {"type": "string"},
+                        "suggested_work": {"type": "string"},
+                        "priority": {"type": "string", "enum": PRIORITY_OPTIONS},
+                        "notes": {"type": "string"}
+                    },
+                    "required": ["location", "current_state", "suggested_work", "priority", "notes"]
+                }
+            },
+            "observation": {"type": "string"}
+        },
+        "required": ["file_name", "findings", "observation"]
+    }
+}
+
+@st.cache_resource
+def get_report_generation_config():
+    """出力をスキーマに制約する生成設定を返す（全セッションで1つだけ保持）"""
+    # 辞書のまま渡すとスキーマの型名が変換されずにリクエストの組み立てで失敗するため、SDKの型で包む
+    from vertexai.generative_models import GenerationConfig
+    return GenerationConfig(
+        response_mime_type="application/json",
+        response_schema=REPORT_RESPONSE_SCHEMA
+    )
+
+async def generate_ai_report_async(model, file_batch, prompt, on_chunk=None):
+    """ストリーミングで応答を受け取り、全文を連結して返す（非同期版）"""
+    from google.api_core import exceptions as api_exceptions
+    from vertexai.generative_models import Part
+    image_parts = [Part.from_data(f['bytes'], mime_type=f['mime']) for f in file_batch]
+    # クォータ超過・一時的な停止は、待ち時間を指数的に伸ばしながら再送する
+    async for attempt in AsyncRetrying(
+        wait=wait_exponential_jitter(initial=1, max=30),
+        stop=stop_after_attempt(AI_MAX_ATTEMPTS),
+        retry=retry_if_exception_type((api_exceptions.ResourceExhausted, api_exceptions.ServiceUnavailable)),
+        reraise=True
+    ):
+        with attempt:
+            responses = await model.generate_content_async(
+                [prompt] + image_parts,
+                generation_config=get_report_generation_config(),
+                stream=True
+            )
+            buf = []
+            received = 0
+            async for chunk in responses:
+                # 候補がない・終了理由だけのチャンクは.textが例外を送出するため読み飛ばす
+                if not (chunk.candidates and chunk.candidates[0].content.parts):
+                    continue
+                text = chunk.text
+                buf.append(text)
+                received += len(text)
+                # チャンク受信ごとに進捗を通知
+                if on_chunk:
+                    on_chunk(received)
+    return "".join(buf)
+
+@st.cache_resource
+def get_ai_response_cache():
+    """AIの分析結果を写真ごとに保持する（全セッション共通）"""
+    return {"lock": threading.Lock(), "entries": {}}
+
+@st.cache_data(ttl=24*60*60, max_entries=256, show_spinner=False)
+def shrink_image_for_ai(raw_bytes, mime_type):
+    """AIに送る写真を長辺AI_IMAGE_MAX_EDGEまで縮小し、(バイト列, MIMEタイプ)を返す"""
+    from PIL import Image, ImageOps
+    try:
+        img = Image.open(io.BytesIO(raw_bytes))
+        if max(img.size) <= AI_IMAGE_MAX_EDGE:
+            return raw_bytes, mime_type
+
+        ratio = AI_IMAGE_MAX_EDGE / max(img.size)
+        img.draft('RGB', (int(img.width * ratio), int(img.height * ratio)))
+        # 再エンコードでEXIFの向き情報が失われるため、先に画素を回転しておく
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((AI_IMAGE_MAX_EDGE, AI_IMAGE_MAX_EDGE), Image.Resampling.LANCZOS)
+
+        output = io.BytesIO()
+        img = img.convert('RGB') if img.mode != 'RGB' else img
+        img.save(output, format='JPEG', quality=85)
+        return output.getvalue(), "image/jpeg"
+    except Exception:
+        # 読み込めない画像は元のまま送る
+        return raw_bytes, mime_type
+
+def make_file_entry(raw_bytes, mime_type):
+    """縮小した写真のバイト列・MIMEタイプと、元画像から一度だけ計算した内容ハッシュをまとめる"""
+    ai_bytes, ai_mime = shrink_image_for_ai(raw_bytes, mime_type)
+    return {
+        'bytes': ai_bytes,
+        'mime': ai_mime,
+        'hash': hashlib.blake2b(raw_bytes, digest_size=16).hexdigest()
+    }
+
+def photo_cache_key(file_entry):
+    """モデル・出力スキーマ・プロンプトの雛形と写真の内容ハッシュから、写真ごとの分析結果のキー（ファイル名にも使える16進文字列）を作る"""
+    # モデル・スキーマ・プロンプトを変更した場合は、以前の分析結果を使わないようにキーに含める
+    schema = orjson.dumps(REPORT_RESPONSE_SCHEMA, option=orjson.OPT_SORT_KEYS).decode()
+    key_source = f"{GEMINI_MODEL_NAME}\0{schema}\0{create_report_prompt([])}\0{file_entry['mime']}\0{file_entry['hash']}"
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+def read_photo_analysis_file(key):
+    """ディスクに保存した有効期限内の分析結果を読み込む（なければ、または形式が正しくなければNone）"""
+    path = AI_CACHE_DIR / f"{key}.json"
+    try:
+        if time.time() - path.stat().st_mtime < AI_DISK_CACHE_TTL:
+            item = orjson.loads(path.read_bytes())
+            findings = item.get('findings') if isinstance(item, dict) else None
+            if isinstance(findings, list) and all(isinstance(f, dict) for f in findings):
+                return item
+    except (OSError, orjson.JSONDecodeError):
+        pass
+    return None
+
+def remember_photo_analysis(cache, key, item):
+    """分析結果をメモリに登録し、上限を超えた分は古いものから捨てる"""
+    with cache["lock"]:
+        entries = cache["entries"]
+        entries.pop(key, None)
+        entries[key] = (time.time(), item)
+        while len(entries) > AI_CACHE_MAX_ENTRIES:
+            entries.pop(next(iter(entries)))
+
+def lookup_photo_analysis(cache, key):
+    """キャッシュ済みの分析結果（写真1枚分）を複製して返す（メモリになければディスクを探し、なければNone）"""
+    with cache["lock"]:
+        entry = cache["entries"].get(key)
+    if entry and time.time() - entry[0] < AI_CACHE_TTL:
+        return clone_report_item(entry[1])
+    item = read_photo_analysis_file(key)
+    if item is None:
+        return None
+    remember_photo_analysis(cache, key, item)
+    return clone_report_item(item)
+
+def store_photo_analysis(cache, key, item):
+    """写真1枚分の分析結果をメモリとディスクに保存し、メモリの上限を超えた分は古いものから捨てる"""
+    item = clone_report_item(item)
+    remember_photo_analysis(cache, key, item)
+    try:
+        AI_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        (AI_CACHE_DIR / f"{key}.json").write_bytes(orjson.dumps(item))
+    except OSError:
+        # 書き込めない環境ではメモリ上のキャッシュだけを使う
+        pass
+
+def prune_photo_analysis_files():
+    """ディスク上の分析結果が上限を超えたら、古いものから削除する"""
+    try:
+        paths = sorted(AI_CACHE_DIR.glob("*.json"), key=lambda path: path.stat().st_mtime)
+        for path in paths[:-AI_DISK_CACHE_MAX_FILES]:
+            path.unlink(missing_ok=True)
+    except OSError:
+        pass
+
+_CODE_FENCE_RE = re.compile(r'```(?:json)?\s*(.*?)\s*```', re.DOTALL)
 
 def parse_json_response(text):
-    match = re.search(r'```(json)?\s*(.*?)\s*```', text, re.DOTALL)
-    json_str = match.group(2) if match else text
+    # 指示どおり純粋なJSONが返ってきた場合は正規表現を使わない
+    if '```' in text:
+        match = _CODE_FENCE_RE.search(text)
+        json_str = match.group(1) if match else text
+    else:
+        json_str = text
     try:
-        return json.loads(json_str)
-    except json.JSONDecodeError:
+        return orjson.loads(json_str)
+    except orjson.JSONDecodeError:
         st.error("応答をJSONとして解析できませんでした。")
         st.info("生の応答:"); st.code(text, language="text")
         return None
 
+def report_fingerprint(report):
+    """レポート内容のハッシュ値を返す（変更の有無の判定用）"""
+    return hash(orjson.dumps(report, option=orjson.OPT_SORT_KEYS))
+
+def clone_report_item(item):
+    """写真1枚分の結果を複製する（文字列は不変なので辞書とリストのみコピー）"""
+    return {**item, 'findings': [dict(f) for f in item.get('findings') or []]}
+
+def clone_report(report):
+    """レポートを複製する（文字列は不変なので辞書とリストのみコピー）"""
+    return {
+        **report,
+        'report_data': [clone_report_item(item) for item in report.get('report_data', [])]
+    }
+
 # ----------------------------------------------------------------------
 # 4. レポート表示の関数
 # ----------------------------------------------------------------------
-def optimize_image_for_display(file_obj, max_width=800):
-    """画像を最適化してbase64エンコード"""
+def publish_static_image(image_bytes, mime_type="image/jpeg"):
+    """画像を静的配信ディレクトリに内容ハッシュ名で保存し、imgタグのsrcを返す"""
+    file_name = f"{hashlib.sha256(image_bytes).hexdigest()}.{mime_type.split('/')[-1]}"
+    path = STATIC_DIR / file_name
     try:
-        file_obj.seek(0)
-        img = Image.open(file_obj)
-        
+        if path.exists():
+            # 使用中の画像が期限切れとして削除されないよう、更新日時を新しくする
+            os.utime(path)
+        else:
+            STATIC_DIR.mkdir(exist_ok=True)
+            # 書き込み途中のファイルが配信されないよう、一時ファイルに書いてから置き換える
+            with tempfile.NamedTemporaryFile(dir=STATIC_DIR, suffix=".tmp", delete=False) as tmp:
+                tmp.write(image_bytes)
+            os.replace(tmp.name, path)
+        return f"{STATIC_URL}/{file_name}"
+    except OSError:
+        # 書き込めない環境ではdata URIで埋め込む
+        return f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode()}"
+
+def prune_static_images():
+    """配信ディレクトリの表示用画像のうち、期限を過ぎたものを削除する"""
+    # 静的配信はパスワード認証を通らないため、現場写真を必要以上に残さない
+    expires_before = time.time() - DISPLAY_IMAGE_TTL
+    try:
+        for path in STATIC_DIR.iterdir():
+            if path.stat().st_mtime < expires_before:
+                path.unlink(missing_ok=True)
+    except OSError:
+        pass
+
+@st.cache_resource
+def start_static_image_pruner():
+    """期限切れの表示用画像を定期的に削除するスレッドを起動する（プロセスごとに1つだけ）"""
+    # アップロードがなくても、期限を過ぎた写真が認証なしで配信され続けないようにする
+    def prune_periodically():
+        while True:
+            prune_static_images()
+            time.sleep(STATIC_PRUNE_INTERVAL)
+    threading.Thread(target=prune_periodically, daemon=True).start()
+    return True
+
+@st.cache_data(ttl=DISPLAY_IMAGE_TTL, max_entries=256, show_spinner=False)
+def optimize_image_for_display(raw_bytes, max_width=800):
+    """画像を最適化して静的ファイルとして配信し、(src, エラーメッセージ)を返す（バイト列のハッシュでキャッシュ）"""
+    from PIL import Image, ImageOps
+    try:
+        img = Image.open(io.BytesIO(raw_bytes))
+
+        # 十分小さいJPEGはデコード・再圧縮せずにそのまま使う（ヘッダーの読み込みだけで判定）
+        # 静的配信は認証を通らないため、位置情報などのメタデータを含む写真は再エンコードして取り除く
+        has_metadata = bool(img.getexif()) or 'xmp' in img.info or 'photoshop' in img.info
+        if img.format == 'JPEG' and img.width <= max_width and not has_metadata:
+            return publish_static_image(raw_bytes, "image/jpeg"), None
+
+        # 表示上の幅（EXIFで90度回転する写真は縦横が入れ替わる）
+        display_width = img.height if img.getexif().get(0x0112, 1) in (5, 6, 7, 8) else img.width
+        if display_width > max_width:
+            # JPEGはデコード時に1/2・1/4・1/8へ縮小させ、残りだけをLANCZOSで仕上げる
+            ratio = max_width / display_width
+            img.draft('RGB', (int(img.width * ratio), int(img.height * ratio)))
+        # 再エンコードでEXIFの向き情報が失われるため、先に画素を回転しておく
+        img = ImageOps.exif_transpose(img)
+
         # 画像が大きすぎる場合はリサイズ
         if img.width > max_width:
-            ratio = max_width / img.width
-            new_height = int(img.height * ratio)
-            img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
-        
-        # JPEGに変換して圧縮
+            img.thumbnail((max_width, int(img.height * max_width / img.width)), Image.Resampling.LANCZOS)
+
+        # WebPに変換して圧縮（同等画質でJPEGより小さい）
         output = io.BytesIO()
         img = img.convert('RGB') if img.mode != 'RGB' else img
-        img.save(output, format='JPEG', quality=85, optimize=True)
-        output.seek(0)
-        
-        return base64.b64encode(output.read()).decode()
+        img.save(output, format='WEBP', quality=80, method=4)
+
+        return publish_static_image(output.getvalue(), "image/webp"), None
     except Exception as e:
-        st.warning(f"画像の最適化中にエラーが発生しました: {e}")
-        file_obj.seek(0)
-        return base64.b64encode(file_obj.read()).decode()
+        # バックグラウンドのスレッドからも呼ばれるため、警告は表示せずに呼び出し元へ返す
+        return publish_static_image(raw_bytes), str(e)
 
-def create_photo_row_html(index, item, img_base64=None):
-    """写真と内容を横並びで表示するHTML（読み取り専用）"""
-    file_name = html.escape(str(item.get('file_name', '')))
-    findings = item.get("findings", [])
-    
-    # 写真部分（遅延読み込み対応）
-    photo_html = f'<img src="data:image/jpeg;base64,{img_base64}" class="photo-img" loading="lazy">' if img_base64 else '<div style="height: 150px; background: #f3f4f6; display: flex; align-items: center; justify-content: center; border-radius: 8px;">画像なし</div>'
-    
-    # コンテンツ部分のHTML生成（番号とファイル名を分離）
-    content_html = f'<div class="photo-title">{index}. <span class="photo-filename">{file_name}</span></div>'
-    
-    if findings:
-        for finding in findings:
-            priority = finding.get('priority', '中')
-            priority_class = {
-                '高': 'finding-high',
-                '中': 'finding-medium',
-                '低': 'finding-low'
-            }.get(priority, 'finding-medium')
-            
-            priority_emoji = ''  # 絵文字を使用しない
-            
-            location = html.escape(str(finding.get('location', 'N/A')))
-            current_state = html.escape(str(finding.get('current_state', 'N/A')))
-            suggested_work = html.escape(str(finding.get('suggested_work', 'N/A')))
-            
-            content_html += f'''
-            <div class="{priority_class}">
-                <div class="finding-location">{location} [緊急度: {priority}]</div>
-                <div class="finding-details">
-                    <div>現状: {current_state}</div>
-                    <div>提案: {suggested_work}</div>
-            '''
-            
-            if finding.get('notes'):
-                notes = html.escape(str(finding.get('notes', '')))
-                content_html += f'<div>備考: {notes}</div>'
-            
-            content_html += '</div></div>'
-    elif item.get("observation"):
-        observation = html.escape(str(item.get('observation', '')))
-        content_html += f'<div class="observation-box">所見: {observation}</div>'
-    else:
-        content_html += '<div class="no-finding-box">修繕必要箇所なし</div>'
-    
-    # 全体のHTML
-    return f'''
-    <div class="photo-row">
-        <div class="photo-container">
-            {photo_html}
-        </div>
-        <div class="content-container">
-            {content_html}
+def warn_display_image_error(error):
+    """表示用画像の生成に失敗した場合に警告を表示する"""
+    if error:
+        st.warning(f"画像の最適化中にエラーが発生しました: {error}")
+
+def prewarm_thumbnails(images, cache):
+    """アップロード直後にバックグラウンドで表示用画像を生成しておく"""
+    for name, raw_bytes, mime_type in images:
+        if name not in cache:
+            # レポート表示時と同じく、AI送信用に縮小した写真から作る（縮小結果は送信時にも再利用される）
+            ai_bytes, _ = shrink_image_for_ai(raw_bytes, mime_type)
+            cache[name] = optimize_image_for_display(ai_bytes)
+
+def get_display_image(file_name, raw_bytes):
+    """事前生成済みの表示用画像があれば再利用し、なければその場で生成する"""
+    cache = st.session_state.thumbnail_cache
+    entry = cache.get(file_name)
+    if entry is None:
+        entry = optimize_image_for_display(raw_bytes)
+        cache[file_name] = entry
+    img_src, error = entry
+    warn_display_image_error(error)
+    return img_src
+
+def prepare_display_images(report_data, files_dict):
+    """未生成の表示用画像をスレッドで並列に生成し、ファイル名からsrcへの対応を返す"""
+    cache = st.session_state.thumbnail_cache
+    if not files_dict:
+        return {}
+    missing = list({
+        item['file_name'] for item in report_data
+        if item.get('file_name') in files_dict and item['file_name'] not in cache
+    })
+    if missing:
+        # Pillowのエンコード処理はGILを解放するため、スレッドで並列化できる
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = executor.map(lambda name: optimize_image_for_display(files_dict[name]['bytes']), missing)
+            for name, entry in zip(missing, results):
+                cache[name] = entry
+    # 警告はスクリプトのスレッドからまとめて表示する
+    display_images = {}
+    for name, (img_src, error) in list(cache.items()):
+        warn_display_image_error(error)
+        display_images[name] = img_src
+    return display_images
+
+def summarize_report(report_data):
+    """総指摘件数と緊急度「高」の件数を1回の走査で集計する"""
+    total_findings = 0
+    high_priority_count = 0
+    for item in report_data:
+        findings = item.get("findings") or []
+        total_findings += len(findings)
+        high_priority_count += sum(1 for f in findings if f.get("priority") == "高")
+    return total_findings, high_priority_count
+
+# サマリーカード3枚分のHTML（1回のst.markdownでまとめて送る）
+SUMMARY_CARDS_TEMPLATE = '''
+<div class="metric-row">
+    <div class="metric-card">
+        <div class="metric-value">{photo_count}</div>
+        <div class="metric-label">分析写真枚数</div>
+    </div>
+    <div class="metric-card">
+        <div class="metric-value">{total_findings}</div>
+        <div class="metric-label">総指摘件数</div>
+    </div>
+    <div class="metric-card">
+        <div class="metric-value metric-value-high">{high_priority_count}</div>
+        <div class="metric-label">緊急度「高」</div>
+    </div>
+</div>
+'''
+
+def render_summary_cards(photo_count, total_findings, high_priority_count):
+    """写真枚数・総指摘件数・緊急度「高」の件数をカードで表示する"""
+    st.markdown(
+        SUMMARY_CARDS_TEMPLATE.format(
+            photo_count=photo_count,
+            total_findings=total_findings,
+            high_priority_count=high_priority_count
+        ),
+        unsafe_allow_html=True
+    )
+
+# 写真行のHTMLテンプレート（モジュール読み込み時に一度だけコンパイル）
+PRIORITY_CLASSES = {'高': 'finding-high', '中': 'finding-medium', '低': 'finding-low'}  # 緊急度ごとの表示クラス
+_JINJA_ENV = jinja2.Environment(autoescape=True, trim_blocks=True, lstrip_blocks=True)
+_PHOTO_ROW_TEMPLATE = _JINJA_ENV.from_string('''
+<div class="photo-row">
+    <div class="photo-container">
+        {% if img_src %}
+        <img src="{{ img_src }}" class="photo-img" loading="lazy">
+        {% else %}
+        <div style="height: 150px; background: #f3f4f6; display: flex; align-items: center; justify-content: center; border-radius: 8px;">画像なし</div>
+        {% endif %}
+    </div>
+    <div class="content-container">
+        <div class="photo-title">{{ index }}. <span class="photo-filename">{{ file_name }}</span></div>
+        {% for finding in findings %}
+        {% set priority = finding.get('priority', '中') %}
+        <div class="{{ priority_classes.get(priority, 'finding-medium') }}">
+            <div class="finding-location">{{ finding.get('location', 'N/A') }} [緊急度: {{ priority }}]</div>
+            <div class="finding-details">
+                <div>現状: {{ finding.get('current_state', 'N/A') }}</div>
+                <div>提案: {{ finding.get('suggested_work', 'N/A') }}</div>
+                {% if finding.get('notes') %}
+                <div>備考: {{ finding.get('notes') }}</div>
+                {% endif %}
+            </div>
         </div>
+        {% else %}
+        {% if observation %}
+        <div class="observation-box">所見: {{ observation }}</div>
+        {% else %}
+        <div class="no-finding-box">修繕必要箇所なし</div>
+        {% endif %}
+        {% endfor %}
     </div>
-    '''
+</div>
+''', globals={'priority_classes': PRIORITY_CLASSES})
+
+# 編集画面の写真とファイル名のHTML（固定部分を定数化してformatで埋める）
+EDIT_PHOTO_IMG_TEMPLATE = '<img src="{src}" class="photo-img" loading="lazy">'
+EDIT_PHOTO_CAPTION_TEMPLATE = '<p style="margin-top: 0.5rem; font-size: 0.85rem; color: #9ca3af;">{index}. {file_name}</p>'
+# テンプレートを通さない文字列用のエスケープ表（1回の走査で置換できる）
+_HTML_ESCAPE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;'})
+
+def create_photo_row_html(index, item, img_src=None):
+    """写真と内容を横並びで表示するHTML（読み取り専用）"""
+    # エスケープはテンプレートのautoescapeに任せる
+    return _PHOTO_ROW_TEMPLATE.render(
+        index=index,
+        file_name=item.get('file_name', ''),
+        findings=item.get("findings") or [],
+        observation=item.get("observation"),
+        img_src=img_src,
+    )
+
+FINDING_COLUMNS = ['location', 'current_state', 'suggested_work', 'priority', 'notes']
+FINDING_COLUMN_CONFIG = {
+    'location': st.column_config.TextColumn("場所", default=''),
+    'current_state': st.column_config.TextColumn("現状", width="large", default=''),
+    'suggested_work': st.column_config.TextColumn("提案する工事内容", width="large", default=''),
+    'priority': st.column_config.SelectboxColumn("緊急度", options=PRIORITY_OPTIONS, default='中', required=True),
+    'notes': st.column_config.TextColumn("備考", default='')
+}
+
+def new_finding():
+    """空の指摘事項を作成する"""
+    return {
+        'location': '',
+        'current_state': '',
+        'suggested_work': '',
+        'priority': '中',
+        'notes': ''
+    }
+
+def findings_from_editor(edited_df):
+    """data_editorの編集結果を指摘事項のリストに戻す"""
+    findings = edited_df.fillna('').to_dict('records')
+    for finding in findings:
+        finding['priority'] = finding['priority'] or '中'
+    return findings
+
+def apply_finding_mutations(report_data, mutations, editor_base):
+    """指摘事項の追加・所見からの変更をまとめて適用する"""
+    for kind, i in mutations:
+        item = report_data[i]
+        if kind == 'convert':
+            item['observation'] = ''
+        # 表エディタの元データも差し替え、次回から表で編集できるようにする
+        item['findings'] = [new_finding()]
+        editor_base[i] = [new_finding()]
 
+@st.fragment
 def display_editable_report(report_payload, files_dict):
     """編集可能なレポート表示"""
+    import pandas as pd  # 編集画面でしか使わないため、初回の編集時に読み込む
     # 編集用データの初期化
     if st.session_state.edited_report is None:
-        st.session_state.edited_report = json.loads(json.dumps(report_payload))
+        st.session_state.edited_report = clone_report(report_payload)
+        st.session_state.finding_editor_base = {}
     
     report_data = st.session_state.edited_report.get('report_data', [])
     report_title = st.session_state.edited_report.get('title', '')
@@ -850,150 +702,65 @@ def display_editable_report(report_payload, files_dict):
     st.markdown('</div>', unsafe_allow_html=True)
     
     # サマリー計算
-    total_findings = sum(len(item.get("findings", [])) for item in report_data)
-    high_priority_count = sum(1 for item in report_data for f in item.get("findings", []) if f.get("priority") == "高")
-    
+    total_findings, high_priority_count = summarize_report(report_data)
+
     # サマリー表示
     st.header("分析結果サマリー")
-    col1, col2, col3 = st.columns(3)
-    with col1:
-        st.markdown(f'''
-            <div class="metric-card">
-                <div class="metric-value">{len(report_data)}</div>
-                <div class="metric-label">分析写真枚数</div>
-            </div>
-        ''', unsafe_allow_html=True)
-    
-    with col2:
-        st.markdown(f'''
-            <div class="metric-card">
-                <div class="metric-value">{total_findings}</div>
-                <div class="metric-label">総指摘件数</div>
-            </div>
-        ''', unsafe_allow_html=True)
-    
-    with col3:
-        st.markdown(f'''
-            <div class="metric-card">
-                <div class="metric-value metric-value-high">{high_priority_count}</div>
-                <div class="metric-label">緊急度「高」</div>
-            </div>
-        ''', unsafe_allow_html=True)
+    render_summary_cards(len(report_data), total_findings, high_priority_count)
     
     st.markdown("---")
     
     # 詳細分析結果（編集可能）
     st.header("詳細分析結果")
+    st.caption("指摘事項は表のセルを直接編集できます。行の追加・削除は表の右上・左端から行えます。")
+    
+    # 表エディタに渡す元データ（再実行のたびに変えると編集差分が二重に適用されるため固定する）
+    editor_base = st.session_state.finding_editor_base
     
     # 各写真を編集可能な形で表示
+    no_issue_indices = []
     for i, item in enumerate(report_data):
+        # 指摘も所見もない写真は個別に描画せず、最後に一覧でまとめて表示する
+        if not item.get("findings") and not item.get("observation") and i not in editor_base:
+            no_issue_indices.append(i)
+            continue
+
         with st.container():
             # 写真と基本情報の表示
             col1, col2 = st.columns([1, 2])
             
             with col1:
-                # 写真表示
-                if files_dict and item.get('file_name') in files_dict:
-                    try:
-                        file_obj = files_dict[item['file_name']]
-                        img_base64 = optimize_image_for_display(file_obj)
-                        st.markdown(f'<img src="data:image/jpeg;base64,{img_base64}" class="photo-img">', unsafe_allow_html=True)
-                    except Exception as e:
-                        st.error(f"画像の表示エラー: {str(e)}")
-                        st.info("画像を表示できません")
-                else:
-                    st.info("画像なし")
+                # 写真表示（先頭以外は折りたたみ、画像の読み込みを開いたときまで遅らせる）
+                with st.expander("写真", expanded=i < EDIT_EXPANDED_PHOTOS):
+                    if files_dict and item.get('file_name') in files_dict:
+                        try:
+                            raw_bytes = files_dict[item['file_name']]['bytes']
+                            img_src = get_display_image(item['file_name'], raw_bytes)
+                            st.markdown(EDIT_PHOTO_IMG_TEMPLATE.format(src=img_src), unsafe_allow_html=True)
+                        except Exception as e:
+                            st.error(f"画像の表示エラー: {str(e)}")
+                            st.info("画像を表示できません")
+                    else:
+                        st.info("画像なし")
                 # ファイル名をグレーで小さく表示
-                st.markdown(f'<p style="margin-top: 0.5rem; font-size: 0.85rem; color: #9ca3af;">{i + 1}. {item.get("file_name", "")}</p>', unsafe_allow_html=True)
+                st.markdown(EDIT_PHOTO_CAPTION_TEMPLATE.format(index=i + 1, file_name=str(item.get("file_name", "")).translate(_HTML_ESCAPE)), unsafe_allow_html=True)
             
             with col2:
                 findings = item.get("findings", [])
                 
-                if findings:
-                    # 指摘事項の編集
-                    findings_to_delete = []
-                    for j, finding in enumerate(findings):
-                        # 現在の場所の値を取得（リアルタイム更新のため）
-                        current_location = finding.get('location', '')
-                        current_priority = finding.get('priority', '中')
-                        
-                        with st.expander(f"指摘事項 {j + 1}: {current_location if current_location else '(未入力)'} ({current_priority})", expanded=True):
-                            # 場所
-                            new_location = st.text_input(
-                                "場所",
-                                value=finding.get('location', ''),
-                                key=f"location_{i}_{j}"
-                            )
-                            
-                            # 現状
-                            new_current_state = st.text_area(
-                                "現状",
-                                value=finding.get('current_state', ''),
-                                key=f"current_{i}_{j}",
-                                height=80
-                            )
-                            
-                            # 提案
-                            new_suggested_work = st.text_area(
-                                "提案する工事内容",
-                                value=finding.get('suggested_work', ''),
-                                key=f"suggest_{i}_{j}",
-                                height=80
-                            )
-                            
-                            # 緊急度
-                            priority_options = ['高', '中', '低']
-                            try:
-                                current_priority = finding.get('priority', '中')
-                                if current_priority not in priority_options:
-                                    current_priority = '中'
-                                current_priority_index = priority_options.index(current_priority)
-                            except ValueError:
-                                current_priority_index = 1  # デフォルトは'中'
-                                
-                            new_priority = st.selectbox(
-                                "緊急度",
-                                options=priority_options,
-                                index=current_priority_index,
-                                key=f"priority_{i}_{j}"
-                            )
-                            
-                            # 備考
-                            new_notes = st.text_area(
-                                "備考",
-                                value=finding.get('notes', ''),
-                                key=f"notes_{i}_{j}",
-                                height=80
-                            )
-                            
-                            # 削除ボタン
-                            if st.button(f"この指摘事項を削除", key=f"delete_{i}_{j}"):
-                                findings_to_delete.append(j)
-                            
-                            # データ更新（リアルタイムで更新しない）
-                            finding['location'] = new_location
-                            finding['current_state'] = new_current_state
-                            finding['suggested_work'] = new_suggested_work
-                            finding['priority'] = new_priority
-                            finding['notes'] = new_notes
-                    
-                    # 削除処理
-                    for idx in reversed(findings_to_delete):
-                        st.session_state.edited_report['report_data'][i]['findings'].pop(idx)
-                        st.rerun()
-                    
-                    # 新規指摘事項追加ボタン
-                    if st.button(f"指摘事項を追加", key=f"add_finding_{i}"):
-                        if 'findings' not in st.session_state.edited_report['report_data'][i]:
-                            st.session_state.edited_report['report_data'][i]['findings'] = []
-                        st.session_state.edited_report['report_data'][i]['findings'].append({
-                            'location': '',
-                            'current_state': '',
-                            'suggested_work': '',
-                            'priority': '中',
-                            'notes': ''
-                        })
-                        st.rerun()
+                if findings or i in editor_base:
+                    # 指摘事項の編集（1つの表エディタで全項目を編集）
+                    if i not in editor_base:
+                        editor_base[i] = [dict(f) for f in findings]
+                    edited_df = st.data_editor(
+                        pd.DataFrame(editor_base[i], columns=FINDING_COLUMNS),
+                        column_config=FINDING_COLUMN_CONFIG,
+                        num_rows="dynamic",
+                        hide_index=True,
+                        use_container_width=True,
+                        key=f"findings_editor_{i}"
+                    )
+                    item['findings'] = findings_from_editor(edited_df)
                 
                 elif item.get("observation"):
                     # 所見の編集
@@ -1005,33 +772,29 @@ def display_editable_report(report_payload, files_dict):
                     )
                     st.session_state.edited_report['report_data'][i]['observation'] = new_observation
                     
-                    # 指摘事項に変更ボタン
-                    if st.button(f"指摘事項に変更", key=f"convert_{i}"):
-                        st.session_state.edited_report['report_data'][i]['observation'] = ''
-                        st.session_state.edited_report['report_data'][i]['findings'] = [{
-                            'location': '',
-                            'current_state': '',
-                            'suggested_work': '',
-                            'priority': '中',
-                            'notes': ''
-                        }]
-                        st.rerun()
-                else:
-                    st.info("修繕必要箇所なし")
-                    if st.button(f"指摘事項を追加", key=f"add_new_{i}"):
-                        if 'findings' not in st.session_state.edited_report['report_data'][i]:
-                            st.session_state.edited_report['report_data'][i]['findings'] = []
-                        st.session_state.edited_report['report_data'][i]['findings'].append({
-                            'location': '',
-                            'current_state': '',
-                            'suggested_work': '',
-                            'priority': '中',
-                            'notes': ''
-                        })
-                        st.rerun()
-            
+                    # 指摘事項に変更ボタン（変更はコールバックで適用し、追加の再実行はしない）
+                    st.button(
+                        "指摘事項に変更",
+                        key=f"convert_{i}",
+                        on_click=apply_finding_mutations,
+                        args=(report_data, [('convert', i)], editor_base)
+                    )
+
             st.markdown("---")
 
+    # 修繕不要の写真は1つの一覧と1つのボタンにまとめる
+    if no_issue_indices:
+        with st.expander(f"修繕必要箇所なしの写真 ({len(no_issue_indices)}件)"):
+            st.markdown("\n".join(
+                f"- {i + 1}. {report_data[i].get('file_name', '')}" for i in no_issue_indices
+            ))
+            st.button(
+                "これらの写真に指摘事項を一括で追加",
+                key="add_new_all",
+                on_click=apply_finding_mutations,
+                args=(report_data, [('add', i) for i in no_issue_indices], editor_base)
+            )
+
 def display_full_report(report_payload, files_dict):
     """読み取り専用のレポート表示（既存の関数）"""
     report_data = report_payload.get('report_data', [])
@@ -1047,66 +810,49 @@ def display_full_report(report_payload, files_dict):
     with col2:
         st.markdown(f"**調査日:** {survey_date}")
     st.markdown('</div>', unsafe_allow_html=True)
+
+    # 分析できなかった写真は、処理中の表示が消えた後も分かるように一覧で示す（印刷時は非表示）
+    if st.session_state.unanalyzed_files:
+        st.warning(
+            f"次の{len(st.session_state.unanalyzed_files)}枚の写真は分析できなかったため、レポートに含まれていません。\n\n"
+            + "\n".join(f"- {name}" for name in st.session_state.unanalyzed_files)
+        )
     
     # サマリー
     st.header("分析結果サマリー")
-    total_findings = sum(len(item.get("findings", [])) for item in report_data)
-    high_priority_count = sum(1 for item in report_data for f in item.get("findings", []) if f.get("priority") == "高")
-    
-    col1, col2, col3 = st.columns(3)
-    with col1:
-        st.markdown(f'''
-            <div class="metric-card">
-                <div class="metric-value">{len(report_data)}</div>
-                <div class="metric-label">分析写真枚数</div>
-            </div>
-        ''', unsafe_allow_html=True)
+    # 集計はレポート作成時・編集保存時に済ませてあるものを使う
+    total_findings, high_priority_count = st.session_state.report_summary or summarize_report(report_data)
     
-    with col2:
-        st.markdown(f'''
-            <div class="metric-card">
-                <div class="metric-value">{total_findings}</div>
-                <div class="metric-label">総指摘件数</div>
-            </div>
-        ''', unsafe_allow_html=True)
-    
-    with col3:
-        st.markdown(f'''
-            <div class="metric-card">
-                <div class="metric-value metric-value-high">{high_priority_count}</div>
-                <div class="metric-label">緊急度「高」</div>
-            </div>
-        ''', unsafe_allow_html=True)
+    render_summary_cards(len(report_data), total_findings, high_priority_count)
     
     st.markdown("---")
     
     # 詳細分析結果
     st.header("詳細分析結果")
     
-    # プログレスバーで画像処理状況を表示
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    
-    # 各写真を横並びレイアウトで表示
+    # 画像の最適化を先にまとめて並列実行
+    # （生成済みなら一瞬で終わるため、時間がかかったときだけスピナーが表示される）
+    with st.spinner("画像を処理中..."):
+        display_images = prepare_display_images(report_data, files_dict)
+
+    # 各写真の横並びレイアウトHTMLを組み立て、最後にまとめて1回で表示
+    # 内容と画像が前回と同じ行は、前回組み立てたHTMLをそのまま使う
+    row_cache = st.session_state.row_html_cache
+    next_row_cache = {}
+    photo_rows = []
     for i, item in enumerate(report_data):
-        # 進捗状況を更新
-        progress = (i + 1) / len(report_data)
-        progress_bar.progress(progress)
-        status_text.text(f"画像を処理中... ({i + 1}/{len(report_data)})")
-        
-        img_base64 = None
+        img_src = None
         if files_dict and item.get('file_name') in files_dict:
-            file_obj = files_dict[item['file_name']]
-            # 画像を最適化
-            img_base64 = optimize_image_for_display(file_obj)
-        
-        # 横並びの写真行を表示
-        photo_row_html = create_photo_row_html(i + 1, item, img_base64)
-        st.markdown(photo_row_html, unsafe_allow_html=True)
-    
-    # プログレスバーを削除
-    progress_bar.empty()
-    status_text.empty()
+            img_src = display_images.get(item['file_name'])
+
+        row_key = (i + 1, img_src, orjson.dumps(item))
+        row_html = row_cache.get(row_key) or create_photo_row_html(i + 1, item, img_src)
+        next_row_cache[row_key] = row_html
+        photo_rows.append(row_html)
+
+    # 今回表示した行だけを残し、古い内容のHTMLは捨てる
+    st.session_state.row_html_cache = next_row_cache
+    st.markdown("".join(photo_rows), unsafe_allow_html=True)
 
 # ----------------------------------------------------------------------
 # 5. メインアプリケーション
@@ -1114,12 +860,14 @@ def display_full_report(report_payload, files_dict):
 def main():
     # CSSを最初に注入して全体のスタイルを設定（認証画面でも適用）
     inject_custom_css()
+    inject_print_shortcut_hook()
+    start_static_image_pruner()
     
     # パスワード認証チェック
     if not check_password():
         return
     
-    model = initialize_vertexai()
+    vertexai_ready = initialize_vertexai()
 
     # --- 状態1: レポートが生成済み ---
     if st.session_state.report_payload is not None:
@@ -1130,14 +878,18 @@ def main():
         with col1:
             if st.session_state.edit_mode:
                 if st.button("編集を保存して表示モードへ", key="save_edit", use_container_width=True):
-                    # 編集内容を保存
-                    st.session_state.report_payload = json.loads(json.dumps(st.session_state.edited_report))
+                    # 編集内容を保存（作業用コピーはこの後使わないので、複製せずそのまま引き継ぐ）
+                    if report_fingerprint(st.session_state.edited_report) != st.session_state.edit_baseline_hash:
+                        st.session_state.report_payload = st.session_state.edited_report
+                        st.session_state.report_summary = summarize_report(st.session_state.report_payload['report_data'])
+                    st.session_state.edited_report = None
                     st.session_state.edit_mode = False
                     st.rerun()
             else:
                 if st.button("レポートを編集", key="start_edit", use_container_width=True):
                     st.session_state.edit_mode = True
                     st.session_state.edited_report = None  # 編集データをリセット
+                    st.session_state.edit_baseline_hash = report_fingerprint(st.session_state.report_payload)
                     st.rerun()
         
         with col2:
@@ -1175,10 +927,14 @@ def main():
     st.title("現場写真分析・報告書作成システム")
     st.markdown("現場写真をアップロードすると、修繕提案レポートを自動作成します。")
 
-    if not model:
+    if not vertexai_ready:
         st.warning("モデルを読み込めませんでした。")
         st.stop()
 
+    # 前回の分析処理の失敗は、処理中の表示と一緒に消えてしまうため再実行後に表示する
+    if st.session_state.analysis_error:
+        st.error(f"分析処理でエラーが発生しました: {st.session_state.analysis_error}")
+
     # 処理中の場合、警告メッセージを表示
     if st.session_state.processing:
         st.warning("現在処理中です。しばらくお待ちください...")
@@ -1196,6 +952,19 @@ def main():
     
     if uploaded_files and not st.session_state.processing:
         st.success(f"{len(uploaded_files)}件の写真がアップロードされました。")
+
+        # AI分析の待ち時間と重ねて、表示用画像をバックグラウンドで先に生成しておく
+        upload_key = tuple((f.name, f.size) for f in uploaded_files)
+        if st.session_state.prewarm_key != upload_key:
+            st.session_state.prewarm_key = upload_key
+            st.session_state.thumbnail_cache = {}
+            prune_static_images()
+            images = [(f.name, f.getvalue(), f.type) for f in uploaded_files]
+            threading.Thread(
+                target=prewarm_thumbnails,
+                args=(images, st.session_state.thumbnail_cache),
+                daemon=True
+            ).start()
     
     # ボタンの作成（処理中は無効化）
     button_label = "処理中..." if st.session_state.processing else "レポートを作成"
@@ -1212,51 +981,146 @@ def main():
     if submitted and not st.session_state.processing and uploaded_files:
         # 処理開始前に即座にprocessingフラグを設定
         st.session_state.processing = True
+        st.session_state.analysis_error = None
         
         # すぐに処理を開始（rerunnを使わない）
         ui_placeholder = st.empty()
-        with ui_placeholder.container():
-            total_batches = math.ceil(len(uploaded_files) / BATCH_SIZE)
-            progress_bar = st.progress(0, text="分析の準備をしています...")
-            
-            final_report_data = []
-            try:
-                for i in range(0, len(uploaded_files), BATCH_SIZE):
-                    current_batch_num = (i // BATCH_SIZE) + 1
-                    progress_text = f"写真を分析中... (バッチ {current_batch_num}/{total_batches})"
-                    progress_bar.progress(i / len(uploaded_files), text=progress_text)
-
-                    file_batch = uploaded_files[i:i + BATCH_SIZE]
-                    filenames = [f.name for f in file_batch]
-                    prompt = create_report_prompt(filenames)
-                    
-                    response_text = generate_ai_report(model, file_batch, prompt)
+        # フラグを立てた直後からtryに入れ、途中で再実行・例外が起きても必ずフラグを戻す
+        try:
+            with ui_placeholder.container():
+                # バイト列は最初に一度だけ取り出し、以降はUploadedFileを使わない
+                # AI送信用の縮小はPillowがGILを解放するため、スレッドで並列に行う
+                with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                    entries = executor.map(lambda f: make_file_entry(f.getvalue(), f.type), uploaded_files)
+                    files_dict = {f.name: entry for f, entry in zip(uploaded_files, entries)}
+                file_names = list(files_dict)
+
+                # 以前に分析済みの写真（内容とプロンプトが同じ）はAIに送らず、結果を再利用する
+                ai_cache = get_ai_response_cache()
+                photo_keys = {name: photo_cache_key(files_dict[name]) for name in file_names}
+                analyzed_items = {}
+                for name in file_names:
+                    cached_item = lookup_photo_analysis(ai_cache, photo_keys[name])
+                    if cached_item is not None:
+                        analyzed_items[name] = {**cached_item, 'file_name': name}
+                batches = plan_batches([name for name in file_names if name not in analyzed_items], files_dict)
+                total_batches = len(batches)
+                progress_bar = st.progress(0, text="分析の準備をしています...")
+
+                # 全バッチの完了を待たず、分析が済んだ写真から順にレポートの行を表示する
+                preview_area = st.container()
+                photo_numbers = {name: k for k, name in enumerate(file_names, 1)}
+
+                def show_preview(items):
+                    thumbnails = st.session_state.thumbnail_cache
+                    rows = [
+                        create_photo_row_html(photo_numbers[item['file_name']], item, thumbnails.get(item['file_name'], (None, None))[0])
+                        for item in items
+                    ]
+                    if rows:
+                        preview_area.markdown("".join(rows), unsafe_allow_html=True)
+
+                # 再利用した分析結果はすぐに表示できる
+                show_preview(analyzed_items.values())
+
+                # 全バッチを同時にAIへ送信し、完了数と受信文字数で進捗を表示
+                received_chars = [0] * total_batches
+                completed = 0
+                last_progress_update = 0.0
+
+                def show_progress(force=False):
+                    # チャンクごとの更新は間引き、最大でPROGRESS_INTERVAL秒に1回だけ描画する
+                    nonlocal last_progress_update
+                    now = time.monotonic()
+                    if not force and now - last_progress_update < PROGRESS_INTERVAL:
+                        return
+                    last_progress_update = now
+                    progress_bar.progress(
+                        completed / total_batches,
+                        text=f"写真を分析中... (完了 {completed}/{total_batches} バッチ, 受信 {sum(received_chars)}文字)"
+                    )
+
+                async def run_batch(model, batch_index, batch_names, semaphore):
+                    nonlocal completed
+                    prompt = create_report_prompt(batch_names)
+                    file_batch = [files_dict[name] for name in batch_names]
+
+                    def on_chunk(chars):
+                        received_chars[batch_index] = chars
+                        show_progress()
+
+                    # Vertex AIのレート制限に掛からないよう同時実行数を制限する
+                    async with semaphore:
+                        response_text = await generate_ai_report_async(model, file_batch, prompt, on_chunk=on_chunk)
+                    completed += 1
+                    show_progress(force=True)
                     batch_report_data = parse_json_response(response_text)
-                    
-                    if batch_report_data:
-                        final_report_data.extend(batch_report_data)
-                    else:
-                        st.error(f"バッチ {current_batch_num} の分析でエラーが発生しました。")
-                
+                    if isinstance(batch_report_data, list):
+                        show_preview([item for item in batch_report_data if isinstance(item, dict) and item.get('file_name') in batch_names])
+                    return batch_report_data
+
+                async def run_all_batches():
+                    # モデルはこのイベントループ内で作成する（前回のループに紐づいたクライアントを使い回さない）
+                    model = create_report_model()
+                    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+                    # 1つのバッチが失敗しても、他のバッチの結果は捨てずに使う
+                    return await asyncio.gather(
+                        *[run_batch(model, k, b, semaphore) for k, b in enumerate(batches)],
+                        return_exceptions=True
+                    )
+
+                batch_results = asyncio.run(run_all_batches())
+                # 再実行・停止の要求（RerunException等）や中断はバッチの失敗として扱わず、そのまま送出する
+                for batch_report_data in batch_results:
+                    if isinstance(batch_report_data, BaseException) and not isinstance(batch_report_data, Exception):
+                        raise batch_report_data
+
+                # 結果を写真ごとに振り分け、対応が取れたものだけをキャッシュする
+                unmatched_items = []
+                for batch_num, (batch_names, batch_report_data) in enumerate(zip(batches, batch_results), 1):
+                    if isinstance(batch_report_data, Exception):
+                        st.error(f"バッチ {batch_num} の分析でエラーが発生しました: {batch_report_data}")
+                        continue
+                    if not isinstance(batch_report_data, list) or not batch_report_data:
+                        st.error(f"バッチ {batch_num} の分析でエラーが発生しました。")
+                        continue
+                    for item in batch_report_data:
+                        name = item.get('file_name')
+                        if name in batch_names and name not in analyzed_items:
+                            analyzed_items[name] = item
+                            store_photo_analysis(ai_cache, photo_keys[name], item)
+                        else:
+                            unmatched_items.append(item)
+
+                if batches:
+                    prune_photo_analysis_files()
+
+                # アップロード順に並べ、ファイル名が対応しない結果は最後に付け足す
+                final_report_data = [analyzed_items[name] for name in file_names if name in analyzed_items]
+                final_report_data.extend(unmatched_items)
+                # 失敗したバッチの写真など、結果が得られなかった写真を記録しておく
+                st.session_state.unanalyzed_files = [name for name in file_names if name not in analyzed_items]
+
                 progress_bar.progress(1.0, text="分析完了")
                 
-                # レポートの保存
-                st.session_state.files_dict = {f.name: f for f in uploaded_files}
+                # レポートの保存（UploadedFileではなく取り出したバイト列を保持）
+                st.session_state.files_dict = files_dict
                 st.session_state.report_payload = {
                     "title": report_title,
                     "date": survey_date.strftime('%Y年%m月%d日'),
                     "report_data": final_report_data
                 }
-                
-            except Exception as e:
-                st.error(f"分析処理でエラーが発生しました: {e}")
-                st.session_state.processing = False
-                st.session_state.report_payload = None
-            finally:
-                # 処理完了後にフラグをリセット
-                st.session_state.processing = False
-                ui_placeholder.empty()
-                st.rerun()
+                st.session_state.report_summary = summarize_report(final_report_data)
+
+        except Exception as e:
+            st.session_state.analysis_error = str(e)
+            st.session_state.processing = False
+            st.session_state.report_payload = None
+        finally:
+            # 処理完了後にフラグをリセット
+            st.session_state.processing = False
+            ui_placeholder.empty()
+            st.rerun()
 
 if __name__ == "__main__":
     main()